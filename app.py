@@ -1,21 +1,100 @@
 import os
+import re
+import atexit
+import json
+import time
+import random
 import base64
+import hashlib
+import tempfile
 import datetime
+import threading
 import asyncio
 import logging
+import collections
+import contextvars
+import httpx
+import orjson
+import httplib2
 import requests
 from flask import Flask, request
+from flask.json.provider import JSONProvider
+from a2wsgi import WSGIMiddleware
 import telegram
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
+from googleapiclient.model import JsonModel
+from google.auth.transport.requests import AuthorizedSession, Request
 from telegram.request import HTTPXRequest
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+class ORJSONProvider(JSONProvider):
+    """Flask JSON provider backed by orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+# Long-lived event loop that runs every async view (see LoopFlask), so
+# loop-bound resources like the OpenRouter client are shared by all requests
+_app_loop = None
+_app_loop_lock = threading.Lock()
+
+def new_event_loop():
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.new_event_loop()
+    return uvloop.new_event_loop()
+
+def get_app_loop():
+    global _app_loop
+    with _app_loop_lock:
+        if _app_loop is None:
+            loop = new_event_loop()
+            threading.Thread(target=loop.run_forever, name="app-loop", daemon=True).start()
+            _app_loop = loop
+        return _app_loop
+
+class LoopFlask(Flask):
+    """Flask app that runs async views on the shared app loop instead of a fresh loop per request."""
+
+    def async_to_sync(self, func):
+        def run(*args, **kwargs):
+            # Carry the request thread's context (Flask's request/app context) into the task
+            context = contextvars.copy_context()
+
+            async def call():
+                for var, value in context.items():
+                    var.set(value)
+                return await func(*args, **kwargs)
+
+            return asyncio.run_coroutine_threadsafe(call(), get_app_loop()).result()
+        return run
+
+class ORJSONModel(JsonModel):
+    """googleapiclient response model that parses JSON bodies with orjson."""
+
+    def deserialize(self, content):
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return super().deserialize(content)
+        if self._data_wrapper and "data" in body:
+            body = body["data"]
+        return body
+
+app = LoopFlask(__name__)
+app.json = ORJSONProvider(app)
+
+# ASGI entry point: uvicorn app:asgi_app serves the WSGI app from a thread pool
+WSGI_THREADS = int(os.environ.get("WSGI_THREADS", "16"))
+asgi_app = WSGIMiddleware(app, workers=WSGI_THREADS)
 
 # Environment variables
 TELEGRAM_TOKEN = os.environ["TELEGRAM_TOKEN"]
@@ -24,6 +103,7 @@ GOOGLE_REFRESH_TOKEN = os.environ["GOOGLE_REFRESH_TOKEN"]
 GOOGLE_CLIENT_ID = os.environ["GOOGLE_CLIENT_ID"]
 GOOGLE_CLIENT_SECRET = os.environ["GOOGLE_CLIENT_SECRET"]
 SHEET_ID = os.environ["SHEET_ID"]
+GOOGLE_TOKEN_CACHE = os.environ.get("GOOGLE_TOKEN_CACHE", "/tmp/gcreds.json")
 
 SCOPES = [
     "https://www.googleapis.com/auth/gmail.readonly",
@@ -40,8 +120,10 @@ httpx_request = HTTPXRequest(
 )
 bot = telegram.Bot(token=TELEGRAM_TOKEN, request=httpx_request)
 
-# Cache for processed update IDs
-processed_updates = set()
+# Cache for processed update IDs, evicting the oldest past MAX_PROCESSED_UPDATES
+MAX_PROCESSED_UPDATES = 10_000
+processed_updates = collections.OrderedDict()
+processed_updates_lock = threading.Lock()
 
 # Store user-selected sender names per chat_id
 user_sender_names = {}
@@ -49,48 +131,263 @@ user_sender_names = {}
 # Predefined staff/company names
 PREDEFINED_SENDERS = ["Mehrbod", "Donchamp"]
 
-# Cached credentials
+# Fixed bot replies
+START_MESSAGE = (
+    "Welcome to the Email Analyzer Bot!\n"
+    "Please choose a sender to filter emails from:\n"
+    f"Predefined options: {', '.join(PREDEFINED_SENDERS)}\n"
+    "Or reply with a custom name or email.\n"
+    "Use /listsenders to see senders of latest unread emails.\n"
+    "Then use /checkemails to fetch and analyze the filtered emails."
+)
+NO_SENDER_MESSAGE = "Please reply with a sender name first, then use /checkemails."
+HELP_MESSAGE = "Please use /start, /listsenders, or /checkemails, or reply with a sender name."
+
+# OpenRouter request constants
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+OPENROUTER_MODEL = "openai/gpt-3.5-turbo"
+OPENROUTER_HEADERS = {
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "Content-Type": "application/json",
+    "HTTP-Referer": "https://email-automation-mehrbodcrud285-rmkp8erf.leapcell.dev",  # Replace with your Leapcell URL
+    "X-Title": "Email Analyzer"
+}
+ANALYZE_PROMPT = "Analyze this email, Summarize and suggest a professional reply: Subject: %s Content: %s"
+
+# Longer bodies are cut to their head and tail before prompting
+MAX_BODY_CHARS = 6000
+BODY_HEAD_CHARS = 4000
+BODY_TAIL_CHARS = 1500
+QUOTED_REPLY_RE = re.compile(r"\nOn .+ wrote:\n(?:>.*(?:\n|$))+")
+
+# LRU cache of suggestions keyed by a digest of subject and body
+SUGGESTION_CACHE_SIZE = 1024
+SUGGESTION_CACHE_TTL = 24 * 60 * 60
+_suggestion_cache = collections.OrderedDict()
+_suggestion_cache_lock = threading.Lock()
+
+# OpenRouter client shared by every request on the app loop
+_openrouter_client = None
+
+# Upper bound on concurrent OpenRouter calls across all requests on the app loop
+OPENROUTER_CONCURRENCY = 8
+_openrouter_semaphore = None
+
+# Cached credentials, trusted without re-checking expiry until _creds_deadline
 _creds = None
+_creds_deadline = 0.0
+_creds_saved_expiry = None
+_creds_lock = threading.Lock()
+
+# Renew this long before expiry, so get_credentials() refreshes and saves the
+# token rather than the service session. Must stay above google-auth's own
+# refresh threshold (3m45s), inside which it treats a token as expired.
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+# Cached Google API services, sharing one pooled session per credentials object
+_google_creds = None
+_google_http = None
+_services = {}
+_services_lock = threading.Lock()
+
+def _token_cache_key():
+    return hashlib.sha256(GOOGLE_REFRESH_TOKEN.encode("utf-8")).hexdigest()
+
+def seconds_until_refresh(expiry):
+    return (expiry - TOKEN_REFRESH_MARGIN - datetime.datetime.utcnow()).total_seconds()
+
+def load_cached_credentials():
+    try:
+        with open(GOOGLE_TOKEN_CACHE) as f:
+            cached = json.load(f)
+        if cached.get("key") != _token_cache_key():
+            return None
+        expiry = datetime.datetime.fromisoformat(cached["expiry"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if seconds_until_refresh(expiry) <= 0:
+        return None
+    return Credentials(
+        cached["access_token"],
+        expiry=expiry,
+        refresh_token=GOOGLE_REFRESH_TOKEN,
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id=GOOGLE_CLIENT_ID,
+        client_secret=GOOGLE_CLIENT_SECRET,
+        scopes=SCOPES
+    )
+
+def save_cached_credentials(creds):
+    cached = {
+        "key": _token_cache_key(),
+        "access_token": creds.token,
+        "expiry": creds.expiry.isoformat()
+    }
+    try:
+        # mkstemp creates the file with 0600 permissions
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(GOOGLE_TOKEN_CACHE))
+        with os.fdopen(fd, "w") as f:
+            json.dump(cached, f)
+        os.replace(tmp_path, GOOGLE_TOKEN_CACHE)
+    except OSError as e:
+        logger.warning(f"Could not write Google token cache: {str(e)}")
 
 def get_credentials():
-    global _creds
-    if _creds is None or not _creds.valid:
-        _creds = Credentials(
-            None,
-            refresh_token=GOOGLE_REFRESH_TOKEN,
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=GOOGLE_CLIENT_ID,
-            client_secret=GOOGLE_CLIENT_SECRET,
-            scopes=SCOPES
-        )
-        if not _creds.valid:
-            _creds.refresh(Request())
-    return _creds
+    global _creds, _creds_deadline, _creds_saved_expiry
+    # Read the deadline first; it is only ever published after _creds
+    deadline = _creds_deadline
+    creds = _creds
+    if creds is not None and time.monotonic() < deadline:
+        return creds
+    with _creds_lock:
+        # Checked against expiry, which the service session may have moved
+        # forward by refreshing _creds in place
+        if _creds is None or seconds_until_refresh(_creds.expiry) <= 0:
+            creds = load_cached_credentials()
+            if creds is not None:
+                _creds_saved_expiry = creds.expiry
+            else:
+                creds = Credentials(
+                    None,
+                    refresh_token=GOOGLE_REFRESH_TOKEN,
+                    token_uri="https://oauth2.googleapis.com/token",
+                    client_id=GOOGLE_CLIENT_ID,
+                    client_secret=GOOGLE_CLIENT_SECRET,
+                    scopes=SCOPES
+                )
+                creds.refresh(Request())
+            _creds = creds
+        if _creds.expiry != _creds_saved_expiry:
+            save_cached_credentials(_creds)
+            _creds_saved_expiry = _creds.expiry
+        _creds_deadline = time.monotonic() + seconds_until_refresh(_creds.expiry)
+        return _creds
+
+class SessionHttp:
+    """httplib2.Http stand-in that sends googleapiclient requests through a requests session."""
+
+    def __init__(self, session):
+        self.session = session
+        # BatchHttpRequest reads this to refresh and re-sign sub-requests that got a 401
+        self.credentials = session.credentials
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=5, connection_type=None):
+        response = self.session.request(method, uri, data=body, headers=headers, timeout=60)
+        # requests has already decoded the body, so drop content-encoding like httplib2 does
+        info = {k: v for k, v in response.headers.items() if k.lower() != "content-encoding"}
+        info["status"] = response.status_code
+        resp = httplib2.Response(info)
+        resp.reason = response.reason
+        return resp, response.content
+
+def build_google_http(creds):
+    # AuthorizedSession adds the bearer token and refreshes it on a 401
+    session = AuthorizedSession(creds)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=3)
+    session.mount("https://", adapter)
+    return SessionHttp(session)
+
+def get_service(name, version):
+    global _google_creds, _google_http
+    with _services_lock:
+        # Read under the lock so a thread holding older credentials can't
+        # replace a session already rebuilt for newer ones
+        creds = get_credentials()
+        # Rebuild only when get_credentials() hands out a new credentials object
+        if creds is not _google_creds:
+            if _google_http is not None:
+                # Services already handed out keep working; the pool reopens on demand
+                _google_http.session.close()
+            _google_creds = creds
+            _google_http = build_google_http(creds)
+            _services.clear()
+        service = _services.get((name, version))
+        if service is None:
+            service = build(
+                name, version, http=_google_http, model=ORJSONModel(),
+                cache_discovery=False, static_discovery=True
+            )
+            _services[(name, version)] = service
+        return service
 
 def get_gmail_service():
-    return build("gmail", "v1", credentials=get_credentials())
+    return get_service("gmail", "v1")
 
 def get_sheets_service():
-    return build("sheets", "v4", credentials=get_credentials())
+    return get_service("sheets", "v4")
+
+def new_openrouter_client():
+    return httpx.AsyncClient(
+        base_url=OPENROUTER_BASE_URL,
+        headers=OPENROUTER_HEADERS,
+        http2=True,
+        timeout=60.0,
+        limits=httpx.Limits(max_connections=30, max_keepalive_connections=20)
+    )
 
-async def send_message_with_retry(bot, chat_id, text, max_retries=5):
+def get_openrouter_client():
+    global _openrouter_client
+    # Only called from views on the app loop, so no lock is needed
+    if _openrouter_client is None:
+        _openrouter_client = new_openrouter_client()
+    return _openrouter_client
+
+def get_openrouter_semaphore():
+    global _openrouter_semaphore
+    # Created on first use so it belongs to the app loop
+    if _openrouter_semaphore is None:
+        _openrouter_semaphore = asyncio.Semaphore(OPENROUTER_CONCURRENCY)
+    return _openrouter_semaphore
+
+@atexit.register
+def stop_app_loop():
+    loop = _app_loop
+    if loop is None:
+        return
+    if _openrouter_client is not None:
+        asyncio.run_coroutine_threadsafe(_openrouter_client.aclose(), loop).result(timeout=5)
+    loop.call_soon_threadsafe(loop.stop)
+
+def backoff_delay(attempt):
+    # Full jitter keeps concurrent retries from firing in lockstep
+    return random.uniform(0, min(2 ** attempt, 30))
+
+async def send_message_with_retry(bot, chat_id, text, max_retries=5, max_read_timeout_retries=1):
+    # A read timeout means Telegram may already have delivered the message, so
+    # resending risks a duplicate; only retry those a limited number of times
+    read_timeouts = 0
     for attempt in range(max_retries):
         try:
             logger.info(f"Sending message to chat_id {chat_id}: {text[:50]}...")
             await bot.send_message(chat_id=chat_id, text=text)
             logger.info(f"Message sent successfully to chat_id {chat_id}")
             return
+        except telegram.error.RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, datetime.timedelta):
+                retry_after = retry_after.total_seconds()
+            logger.warning(f"Rate limited on attempt {attempt + 1}, retry after {retry_after}s")
+            if attempt < max_retries - 1:
+                await asyncio.sleep(retry_after)
+            else:
+                logger.error(f"Failed to send message after {max_retries} attempts: {str(e)}")
+                raise
         except telegram.error.TimedOut as e:
+            if isinstance(e.__cause__, httpx.ReadTimeout):
+                read_timeouts += 1
+                if read_timeouts > max_read_timeout_retries:
+                    logger.error(f"No response from Telegram after {read_timeouts} read timeouts: {str(e)}")
+                    raise
             logger.warning(f"Send message attempt {attempt + 1} failed: {str(e)}")
             if attempt < max_retries - 1:
-                await asyncio.sleep(2 ** attempt)
+                await asyncio.sleep(backoff_delay(attempt))
             else:
                 logger.error(f"Failed to send message after {max_retries} attempts: {str(e)}")
                 raise
         except telegram.error.NetworkError as e:
             logger.warning(f"Network error on attempt {attempt + 1}: {str(e)}")
             if attempt < max_retries - 1:
-                await asyncio.sleep(2 ** attempt)
+                await asyncio.sleep(backoff_delay(attempt))
             else:
                 logger.error(f"Failed to send message after {max_retries} attempts: {str(e)}")
                 raise
@@ -106,10 +403,18 @@ async def webhook():
         return "OK"
 
     update_id = update["update_id"]
-    if update_id in processed_updates:
+    with processed_updates_lock:
+        if update_id in processed_updates:
+            processed_updates.move_to_end(update_id)
+            duplicate = True
+        else:
+            processed_updates[update_id] = None
+            if len(processed_updates) > MAX_PROCESSED_UPDATES:
+                processed_updates.popitem(last=False)
+            duplicate = False
+    if duplicate:
         logger.info(f"Skipping duplicate update_id: {update_id}")
         return "OK"
-    processed_updates.add(update_id)
     logger.info(f"Received update: {update}")
 
     if "message" in update and "text" in update["message"]:
@@ -119,16 +424,7 @@ async def webhook():
         # Handle /start command
         if text == "/start":
             logger.info(f"Processing /start for chat_id: {chat_id}")
-            predefined_options = ", ".join(PREDEFINED_SENDERS)
-            response = (
-                "Welcome to the Email Analyzer Bot!\n"
-                "Please choose a sender to filter emails from:\n"
-                f"Predefined options: {predefined_options}\n"
-                "Or reply with a custom name or email.\n"
-                "Use /listsenders to see senders of latest unread emails.\n"
-                "Then use /checkemails to fetch and analyze the filtered emails."
-            )
-            await send_message_with_retry(bot, chat_id, response)
+            await send_message_with_retry(bot, chat_id, START_MESSAGE)
             # Clear any previous sender name
             user_sender_names.pop(chat_id, None)
 
@@ -136,7 +432,7 @@ async def webhook():
         elif text == "/listsenders":
             logger.info(f"Processing /listsenders for chat_id: {chat_id}")
             try:
-                senders = fetch_emails(return_senders=True)
+                senders = await asyncio.to_thread(fetch_emails, return_senders=True)
                 if not senders:
                     await send_message_with_retry(
                         bot, chat_id, "No unread emails found."
@@ -159,39 +455,25 @@ async def webhook():
             if text == "/checkemails":
                 if chat_id not in user_sender_names:
                     logger.info(f"No sender selected for chat_id: {chat_id}")
-                    await send_message_with_retry(
-                        bot, chat_id, "Please reply with a sender name first, then use /checkemails."
-                    )
+                    await send_message_with_retry(bot, chat_id, NO_SENDER_MESSAGE)
                 else:
                     sender_name = user_sender_names[chat_id]
                     logger.info(f"Processing /checkemails for chat_id: {chat_id}, sender: {sender_name}")
                     try:
-                        emails = fetch_emails(sender_name=sender_name)
+                        emails = await asyncio.to_thread(fetch_emails, sender_name=sender_name)
                         logger.info(f"Fetched {len(emails)} emails for sender: {sender_name}")
                         if not emails:
                             await send_message_with_retry(
                                 bot, chat_id, f"No unread emails found from {sender_name}."
                             )
                         else:
-                            for email in emails:
-                                logger.info(f"Analyzing email: {email['subject']}")
-                                suggestion = analyze_email(email)
-                                logger.info(f"Sending suggestion for: {email['subject']}")
-                                await send_message_with_retry(
-                                    bot, chat_id, f"Subject: {email['subject']}\nSuggested Reply: {suggestion}"
-                                )
-                                save_to_drive(email, suggestion)
-                                logger.info(f"Saved suggestion for: {email['subject']}")
-                            await send_message_with_retry(bot, chat_id, "All emails processed.")
-                            logger.info("All emails processed successfully")
+                            await process_emails(chat_id, emails)
                     except Exception as e:
                         logger.error(f"Error processing emails: {str(e)}", exc_info=True)
                         await send_message_with_retry(bot, chat_id, f"Error: {str(e)}")
             else:
                 logger.info(f"Ignoring command {text} for chat_id: {chat_id}")
-                await send_message_with_retry(
-                    bot, chat_id, "Please use /start, /listsenders, or /checkemails, or reply with a sender name."
-                )
+                await send_message_with_retry(bot, chat_id, HELP_MESSAGE)
         else:
             # Store the sender name
             user_sender_names[chat_id] = text
@@ -202,6 +484,77 @@ async def webhook():
 
     return "OK"
 
+async def process_emails(chat_id, emails):
+    client = get_openrouter_client()
+    tasks = [
+        asyncio.create_task(analyze_email_result(client, email))
+        for email in emails
+    ]
+    results = []
+    try:
+        # Reply to each email as soon as its analysis finishes
+        for next_done in asyncio.as_completed(tasks):
+            email, suggestion = await next_done
+            if isinstance(suggestion, Exception):
+                await send_message_with_retry(
+                    bot, chat_id, f"Subject: {email['subject']}\nError: {str(suggestion)}"
+                )
+                continue
+            logger.info(f"Sending suggestion for: {email['subject']}")
+            await send_message_with_retry(
+                bot, chat_id, f"Subject: {email['subject']}\nSuggested Reply: {suggestion}"
+            )
+            results.append((email, suggestion))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        # Let cancelled analyses unwind before re-raising
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if results:
+            # Keep the suggestions already sent, without masking the original error
+            try:
+                await save_to_drive_async(results)
+            except Exception as e:
+                logger.error(f"Error saving to Google Sheet: {str(e)}", exc_info=True)
+        raise
+    # One Sheets append for every suggestion that was sent
+    if results:
+        await save_to_drive_async(results)
+    await send_message_with_retry(bot, chat_id, "All emails processed.")
+    logger.info("All emails processed successfully")
+
+def execute_batch(service, batch_requests):
+    # Run the requests in a single batched HTTP round trip, returning responses in order
+    responses = []
+    errors = []
+
+    def _collect(request_id, response, exception):
+        if exception is not None:
+            errors.append(exception)
+        else:
+            responses.append(response)
+
+    batch = service.new_batch_http_request(callback=_collect)
+    for req in batch_requests:
+        batch.add(req)
+    batch.execute()
+    if errors:
+        raise errors[0]
+    return responses
+
+def find_plain_text_part(part):
+    # Depth-first, so text/plain nested in multipart/alternative is found too
+    if part["mimeType"] == "text/plain":
+        return part
+    for subpart in part.get("parts", []):
+        found = find_plain_text_part(subpart)
+        if found is not None:
+            return found
+    return None
+
+def decode_body(data):
+    return base64.urlsafe_b64decode(data.encode("ascii")).decode("utf-8")
+
 def fetch_emails(sender_name=None, return_senders=False):
     service = get_gmail_service()
     query = "is:unread"
@@ -209,75 +562,134 @@ def fetch_emails(sender_name=None, return_senders=False):
         query += f" from:{sender_name}"
     results = service.users().messages().list(userId="me", q=query, maxResults=3).execute()
     messages = results.get("messages", [])
-    
+    if not messages:
+        return []
+
     if return_senders:
+        responses = execute_batch(service, [
+            service.users().messages().get(
+                userId="me", id=msg["id"], format="metadata", metadataHeaders=["From"], fields="payload/headers"
+            )
+            for msg in messages
+        ])
         senders = []
-        for msg in messages:
-            msg_data = service.users().messages().get(userId="me", id=msg["id"], format="metadata", metadataHeaders=["From"]).execute()
+        for msg_data in responses:
             headers = {h["name"]: h["value"] for h in msg_data["payload"]["headers"]}
             sender = headers.get("From", "Unknown Sender")
             if sender not in senders:
                 senders.append(sender)
         return senders
-    
+
+    # Only ask for the MIME tree, not snippet, labels or history metadata
+    responses = execute_batch(service, [
+        service.users().messages().get(
+            userId="me", id=msg["id"], format="full", fields="id,payload(headers,mimeType,body,parts)"
+        )
+        for msg in messages
+    ])
     emails = []
-    for msg in messages:
-        msg_data = service.users().messages().get(userId="me", id=msg["id"], format="full").execute()
-        headers = {h["name"]: h["value"] for h in msg_data["payload"]["headers"]}
-        subject = headers.get("Subject", "No Subject")
-        body = ""
-        if "parts" in msg_data["payload"]:
-            for part in msg_data["payload"]["parts"]:
-                if part["mimeType"] == "text/plain":
-                    body = base64.urlsafe_b64decode(part["body"]["data"]).decode("utf-8")
-                    break
-        else:
-            body = base64.urlsafe_b64decode(msg_data["payload"]["body"]["data"]).decode("utf-8")
-        emails.append({"subject": subject, "body": body})
+    attachments = []
+    for msg_data in responses:
+        payload = msg_data["payload"]
+        headers = {h["name"]: h["value"] for h in payload["headers"]}
+        email = {"subject": headers.get("Subject", "No Subject"), "body": ""}
+        part = find_plain_text_part(payload) if "parts" in payload else payload
+        if part is not None:
+            if "data" in part["body"]:
+                email["body"] = decode_body(part["body"]["data"])
+            elif "attachmentId" in part["body"]:
+                # Large bodies aren't inlined; fetch them in a second batch
+                attachments.append((email, msg_data["id"], part["body"]["attachmentId"]))
+        emails.append(email)
+
+    if attachments:
+        responses = execute_batch(service, [
+            service.users().messages().attachments().get(userId="me", messageId=msg_id, id=attachment_id)
+            for _, msg_id, attachment_id in attachments
+        ])
+        for (email, _, _), attachment in zip(attachments, responses):
+            email["body"] = decode_body(attachment["data"])
     return emails
 
-def analyze_email(email):
-    logger.info(f"Sending to OpenRouter: Subject: {email['subject']}")
+def prepare_email_body(body):
+    body = QUOTED_REPLY_RE.sub("\n", body.replace("\r\n", "\n"))
+    if len(body) > MAX_BODY_CHARS:
+        body = body[:BODY_HEAD_CHARS] + "\n...[truncated]...\n" + body[-BODY_TAIL_CHARS:]
+    return body
+
+def suggestion_key(email):
+    content = f"{email['subject']}\0{email['body']}".encode("utf-8")
+    return hashlib.blake2b(content, digest_size=16).digest()
+
+def get_cached_suggestion(key):
+    with _suggestion_cache_lock:
+        cached = _suggestion_cache.get(key)
+        if cached is None:
+            return None
+        timestamp, suggestion = cached
+        if time.monotonic() - timestamp > SUGGESTION_CACHE_TTL:
+            del _suggestion_cache[key]
+            return None
+        _suggestion_cache.move_to_end(key)
+        return suggestion
+
+def cache_suggestion(key, suggestion):
+    with _suggestion_cache_lock:
+        _suggestion_cache[key] = (time.monotonic(), suggestion)
+        _suggestion_cache.move_to_end(key)
+        if len(_suggestion_cache) > SUGGESTION_CACHE_SIZE:
+            _suggestion_cache.popitem(last=False)
+
+async def analyze_email_async(client, email):
+    key = suggestion_key(email)
+    suggestion = get_cached_suggestion(key)
+    if suggestion is not None:
+        logger.info(f"Using cached suggestion for: {email['subject']}")
+        return suggestion
+    async with get_openrouter_semaphore():
+        logger.info(f"Sending to OpenRouter: Subject: {email['subject']}")
+        try:
+            response = await client.post(
+                "/chat/completions",
+                content=orjson.dumps({
+                    "model": OPENROUTER_MODEL,
+                    "messages": [
+                        {
+                            "role": "user",
+                            "content": ANALYZE_PROMPT % (email['subject'], prepare_email_body(email['body']))
+                        }
+                    ]
+                })
+            )
+            logger.info(f"OpenRouter response status: {response.status_code}")
+            logger.info(f"OpenRouter response body: {response.text}")
+            response.raise_for_status()
+            response_data = orjson.loads(response.content)
+            logger.info("OpenRouter response received")
+            suggestion = response_data["choices"][0]["message"]["content"]
+            cache_suggestion(key, suggestion)
+            return suggestion
+        except httpx.HTTPStatusError as e:
+            logger.error(f"OpenRouter HTTP error: {str(e)}", exc_info=True)
+            raise
+        except httpx.RequestError as e:
+            logger.error(f"OpenRouter request error: {str(e)}", exc_info=True)
+            raise
+        except KeyError as e:
+            logger.error(f"OpenRouter response parsing error: {str(e)}", exc_info=True)
+            raise
+
+async def analyze_email_result(client, email):
     try:
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                "Content-Type": "application/json",
-                "HTTP-Referer": "https://email-automation-mehrbodcrud285-rmkp8erf.leapcell.dev",  # Replace with your Leapcell URL
-                "X-Title": "Email Analyzer"
-            },
-            json={
-                "model": "openai/gpt-3.5-turbo",
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": f"Analyze this email, Summarize and suggest a professional reply: Subject: {email['subject']} Content: {email['body']}"
-                    }
-                ]
-            }
-        )
-        logger.info(f"OpenRouter response status: {response.status_code}")
-        logger.info(f"OpenRouter response body: {response.text}")
-        response.raise_for_status()
-        response_data = response.json()
-        logger.info("OpenRouter response received")
-        return response_data["choices"][0]["message"]["content"]
-    except requests.exceptions.HTTPError as e:
-        logger.error(f"OpenRouter HTTP error: {str(e)}", exc_info=True)
-        raise
-    except requests.exceptions.RequestException as e:
-        logger.error(f"OpenRouter request error: {str(e)}", exc_info=True)
-        raise
-    except KeyError as e:
-        logger.error(f"OpenRouter response parsing error: {str(e)}", exc_info=True)
-        raise
+        return email, await analyze_email_async(client, email)
+    except Exception as e:
+        return email, e
 
-def save_to_drive(email, suggestion):
+def save_to_drive(results):
     service = get_sheets_service()
     range_name = "Sheet1!A:C"
-    timestamp = datetime.datetime.now().isoformat()
-    values = [[timestamp, email['subject'], suggestion]]
+    timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+    values = [[timestamp, email['subject'], suggestion] for email, suggestion in results]
     body = {"values": values}
     service.spreadsheets().values().append(
         spreadsheetId=SHEET_ID,
@@ -286,7 +698,12 @@ def save_to_drive(email, suggestion):
         insertDataOption="INSERT_ROWS",
         body=body
     ).execute()
-    logger.info(f"Saved to Google Sheet: {email['subject']}")
+    logger.info(f"Saved {len(values)} rows to Google Sheet")
+
+async def save_to_drive_async(results):
+    # googleapiclient is synchronous, so run it off the event loop
+    await asyncio.to_thread(save_to_drive, results)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080)
\ No newline at end of file
+    import uvicorn
+    uvicorn.run(asgi_app, host="0.0.0.0", port=8080, loop="uvloop", http="httptools", lifespan="off")
\ No newline at end of file
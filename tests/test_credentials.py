@@ -0,0 +1,89 @@
+import os
+import json
+import datetime
+import tempfile
+import unittest
+from unittest import mock
+
+_cache_dir = tempfile.mkdtemp()
+os.environ.update({
+    "TELEGRAM_TOKEN": "1:test",
+    "OPENROUTER_API_KEY": "test",
+    "GOOGLE_REFRESH_TOKEN": "refresh-token",
+    "GOOGLE_CLIENT_ID": "client-id",
+    "GOOGLE_CLIENT_SECRET": "client-secret",
+    "SHEET_ID": "sheet",
+    "GOOGLE_TOKEN_CACHE": os.path.join(_cache_dir, "gcreds.json"),
+})
+
+import app
+from google.oauth2.credentials import Credentials
+
+
+def fake_refresh(creds, request):
+    creds.token = "refreshed-token"
+    creds.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+
+class GetCredentialsTest(unittest.TestCase):
+    def setUp(self):
+        app._creds = None
+        app._creds_deadline = 0.0
+        app._creds_saved_expiry = None
+        if os.path.exists(app.GOOGLE_TOKEN_CACHE):
+            os.remove(app.GOOGLE_TOKEN_CACHE)
+
+    def write_cache(self, token, expires_in):
+        expiry = datetime.datetime.utcnow() + expires_in
+        with open(app.GOOGLE_TOKEN_CACHE, "w") as f:
+            json.dump({
+                "key": app._token_cache_key(),
+                "access_token": token,
+                "expiry": expiry.isoformat()
+            }, f)
+        return os.stat(app.GOOGLE_TOKEN_CACHE).st_mtime_ns
+
+    def read_cache(self):
+        with open(app.GOOGLE_TOKEN_CACHE) as f:
+            return json.load(f)
+
+    @mock.patch.object(Credentials, "refresh", autospec=True, side_effect=fake_refresh)
+    def test_loads_cached_token_with_time_left(self, refresh):
+        mtime = self.write_cache("cached-token", datetime.timedelta(minutes=30))
+
+        creds = app.get_credentials()
+
+        self.assertEqual(creds.token, "cached-token")
+        refresh.assert_not_called()
+        self.assertEqual(os.stat(app.GOOGLE_TOKEN_CACHE).st_mtime_ns, mtime)
+
+    @mock.patch.object(Credentials, "refresh", autospec=True, side_effect=fake_refresh)
+    def test_refreshes_cached_token_inside_margin(self, refresh):
+        self.write_cache("cached-token", datetime.timedelta(minutes=4))
+
+        creds = app.get_credentials()
+
+        self.assertEqual(creds.token, "refreshed-token")
+        refresh.assert_called_once()
+        self.assertEqual(self.read_cache()["access_token"], "refreshed-token")
+
+    @mock.patch.object(Credentials, "refresh", autospec=True, side_effect=fake_refresh)
+    def test_writes_back_in_place_refresh(self, refresh):
+        self.write_cache("cached-token", datetime.timedelta(minutes=30))
+        creds = app.get_credentials()
+
+        # The service session refreshes the shared credentials object itself
+        creds.refresh(None)
+        app._creds_deadline = 0.0
+        app.get_credentials()
+
+        self.assertEqual(self.read_cache()["access_token"], "refreshed-token")
+        self.assertEqual(refresh.call_count, 1)
+
+    def test_margin_exceeds_google_auth_threshold(self):
+        creds = Credentials("token", expiry=datetime.datetime.utcnow() + app.TOKEN_REFRESH_MARGIN)
+        self.assertFalse(creds.expired)
+
+
+if __name__ == "__main__":
+    unittest.main()